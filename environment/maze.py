@@ -95,6 +95,22 @@ class Maze:
                 "Error: exit cell at {} is not free".format(
                     self.__exit_cell))
 
+        # Transition table for playing many games at once (see check_win_all): index of the cell which is reached
+        # by taking an action in a cell, or -1 if the move is impossible
+        self.__next_cell = np.full((nrows * ncols, len(Maze.actions)), -1)
+        for cell in self.empty:
+            for action in self.__possible_actions(cell):
+                col, row = cell
+                if action == Action.MOVE_LEFT:
+                    col -= 1
+                elif action == Action.MOVE_RIGHT:
+                    col += 1
+                elif action == Action.MOVE_UP:
+                    row -= 1
+                elif action == Action.MOVE_DOWN:
+                    row += 1
+                self.__next_cell[self.cell_index(cell), action] = self.cell_index((col, row))
+
         # Variables for rendering using Matplotlib
         self.__render = Render.NOTHING  # what to render
         self.__ax1 = None  # axes for rendering the moves
@@ -155,6 +171,25 @@ class Maze:
 
         return self.__observe()
 
+    @property
+    def exit_cell(self) -> tuple:
+        """ Cell (col, row) which the agent has to reach to win the game. """
+        return self.__exit_cell
+
+    @property
+    def minimum_reward(self) -> float:
+        """ The game is lost as soon as the accumulated reward drops below this threshold. """
+        return self.__minimum_reward
+
+    def cell_index(self, cell=None) -> int:
+        """ Return a unique integer for a cell, cheaper to hash than the observed state.
+
+            :param tuple cell: (col, row) of the cell (optional, else the agents current cell)
+            :return int: row * number of columns + col
+        """
+        col, row = self.__current_cell if cell is None else cell
+        return row * self.maze.shape[1] + col
+
     def __draw(self) -> None:
         """ Draw a line from the agents previous cell to its current cell. """
         self.__ax1.plot(*zip(*[self.__previous_cell,
@@ -203,9 +238,7 @@ class Maze:
         self.__total_reward += reward
         status = self.__status()
         state = self.__observe()
-        logging.debug(
-            "action: {:10s} | reward: {: .2f} | status: {}".format(
-                Action(action).name, reward, status))
+        logging.debug("action: %-10s | reward: % .2f | status: %s", Action(action).name, reward, status)
         return state, reward, status
 
     def __execute(self, action):
@@ -321,21 +354,54 @@ class Maze:
                 return status
 
     def check_win_all(self, model) -> tuple[bool, float]:
-        """ Check if the model wins from all possible starting cells. """
-        previous = self.__render
-        # avoid rendering anything during execution of the check games
-        self.__render = Render.NOTHING
+        """ Check if the model wins from all possible starting cells.
 
-        win = 0
-        lose = 0
+            Instead of calling play() for every start cell all games are played simultaneously. The q values of
+            'model' are fetched once per cell, after which each step advances all unfinished games using the
+            transition table. The rules, rewards and random choice between equal q values are the same as in play().
+        """
+        ncells = self.__next_cell.shape[0]
+        exit_index = self.cell_index(self.__exit_cell)
+        stuck = (self.__next_cell < 0).all(axis=1)  # cells from which the agent cannot move anywhere
 
+        q = np.zeros(self.__next_cell.shape)
         for cell in self.empty:
-            if self.play(model, cell) == Status.WIN:
-                win += 1
-            else:
-                lose += 1
-
-        self.__render = previous  # restore previous rendering setting
+            q[self.cell_index(cell)] = model.q(cell)
+
+        cells = np.array([self.cell_index(cell) for cell in self.empty])
+        total_reward = np.zeros(len(cells))
+        visited = np.zeros((len(cells), ncells), dtype=bool)
+        won = np.zeros(len(cells), dtype=bool)
+        playing = np.ones(len(cells), dtype=bool)
+
+        while playing.any():
+            games = np.flatnonzero(playing)
+            current = cells[games]
+
+            # choose the action with the highest q value, random choice if multiple actions have the same value
+            q_current = q[current]
+            best = q_current == q_current.max(axis=1, keepdims=True)
+            action = np.argmax(best * np.random.random(best.shape), axis=1)
+
+            # execute the actions and collect the rewards, in the same order of precedence as __execute()
+            next_cell = self.__next_cell[current, action]
+            moved = next_cell >= 0
+            next_cell = np.where(moved, next_cell, current)
+
+            reward = np.where(moved, Maze.penalty_move, Maze.penalty_impossible_move)
+            reward[moved & visited[games, next_cell]] = Maze.penalty_visited
+            reward[next_cell == exit_index] = Maze.reward_exit
+            reward[stuck[current]] = self.__minimum_reward - 1
+
+            visited[games[moved], next_cell[moved]] = True
+            total_reward[games] += reward
+            cells[games] = next_cell
+
+            won[games] = next_cell == exit_index
+            playing[games] = ~won[games] & (total_reward[games] >= self.__minimum_reward)
+
+        win = int(won.sum())
+        lose = len(cells) - win
 
         logging.info("won: {} | lost: {} | win rate: {:.5f}".format(
             win, lose, win / (win + lose)))
@@ -59,14 +59,14 @@ def main(args) -> None:
         game.render(Render.TRAINING)
         model = models.QTableModel(game)
         h, w, _, _ = model.train(discount=0.90, exploration_rate=0.10, learning_rate=0.10, episodes=50,
-                                 stop_at_convergence=True)
+                                 stop_at_convergence=True, render_every=1)
 
     # train using tabular Q-learning and an eligibility trace (aka TD-lambda)
     if test == Test.Q_ELIGIBILITY:
         game.render(Render.TRAINING)
         model = models.QTableTraceModel(game)
         h, w, _, _ = model.train(discount=0.90, exploration_rate=0.10, learning_rate=0.10, episodes=50,
-                                 stop_at_convergence=True)
+                                 stop_at_convergence=True, render_every=1)
 
     # train using tabular SARSA learning
     if test == Test.SARSA:
@@ -1,8 +1,30 @@
 """ Abstract base class for prediction models.
 """
+import random
 from abc import ABC, abstractmethod
 
 
+def greedy_action(q):
+    """ Index of the action with the max value, ties are broken uniformly at random (reservoir sampling).
+
+        :param list q: q values per action
+        :return int: selected action
+    """
+    best = q[0]
+    action = 0
+    count = 1
+    for i in range(1, len(q)):
+        if q[i] > best:
+            best = q[i]
+            action = i
+            count = 1
+        elif q[i] == best:
+            count += 1
+            if random.randrange(count) == 0:
+                action = i
+    return action
+
+
 class AbstractModel(ABC):
     def __init__(self, maze, **kwargs):
         self.environment = maze
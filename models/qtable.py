@@ -2,19 +2,124 @@ import logging
 import random
 from datetime import datetime
 
+import numba
 import numpy as np
 
 from environment import Status
-from models import AbstractModel
+from environment.maze import Cell, Maze
+from models import AbstractModel, greedy_action
+
+
+@numba.njit(cache=True)
+def _seed(seed):
+    """ Seed numba's random generator, which is separate from the random and np.random generators. """
+    np.random.seed(seed)
+
+
+@numba.njit(cache=True)
+def _argmax(q):
+    """ Index of the highest value in q, ties are broken uniformly at random.
+
+        Compiled counterpart of greedy_action(), keep both in line.
+    """
+    best = q[0]
+    idx = 0
+    count = 1
+    for i in range(1, q.shape[0]):
+        if q[i] > best:
+            best = q[i]
+            idx = i
+            count = 1
+        elif q[i] == best:
+            count += 1
+            if np.random.randint(count) == 0:  # reservoir sampling among the equal maxima
+                idx = i
+    return idx
+
+
+@numba.njit(cache=True)
+def _run_episode(Q, walls, start_r, start_c, exit_r, exit_c, eps, alpha, gamma, minimum_reward,
+                 reward_exit, penalty_move, penalty_visited, penalty_impossible_move):
+    """ Play a single training game from (start_r, start_c) and update Q in place.
+
+        Follows the same rules as Maze.step(), but directly on the 'walls' grid so the whole episode runs as
+        compiled code. Actions are indexed as in environment.maze.Action (left, right, up, down).
+
+        :return float, bool: reward accumulated during the episode, True if the exit was reached
+    """
+    nrows, ncols = walls.shape
+    n_actions = Q.shape[2]
+    d_row = (0, 0, -1, 1)
+    d_col = (-1, 1, 0, 0)
+
+    visited = np.zeros((nrows, ncols), dtype=np.bool_)
+    row, col = start_r, start_c
+    total_reward = 0.0  # only used for the win/lose check, kept in double precision as in Maze
+
+    while True:
+        # choose action epsilon greedy (off-policy, instead of only using the learned policy)
+        if np.random.random() < eps:
+            action = np.random.randint(n_actions)
+        else:
+            action = _argmax(Q[row, col])
+
+        # execute the action, same rewards and penalties as Maze.step()
+        possible = False
+        for a in range(n_actions):
+            r = row + d_row[a]
+            c = col + d_col[a]
+            if 0 <= r < nrows and 0 <= c < ncols and walls[r, c] == 0:
+                possible = True
+                break
+
+        next_row, next_col = row, col
+        if not possible:
+            reward = minimum_reward - np.float32(1)  # cannot move anywhere, force end of game
+        else:
+            r = row + d_row[action]
+            c = col + d_col[action]
+            if 0 <= r < nrows and 0 <= c < ncols and walls[r, c] == 0:
+                next_row, next_col = r, c
+                if r == exit_r and c == exit_c:
+                    reward = reward_exit
+                elif visited[r, c]:
+                    reward = penalty_visited
+                else:
+                    reward = penalty_move
+                visited[r, c] = True
+            else:
+                reward = penalty_impossible_move
+
+        total_reward += reward
+
+        won = next_row == exit_r and next_col == exit_c
+        lost = total_reward < minimum_reward  # force end of game after too much loss
+
+        # Q formula with TD, there is no future reward after a terminal state
+        if won or lost:
+            target = reward
+        else:
+            target = reward + gamma * Q[next_row, next_col].max()
+        q_sa = Q[row, col, action]
+        Q[row, col, action] = q_sa + alpha * (target - q_sa)
+
+        if won or lost:
+            return total_reward, won
+
+        row, col = next_row, next_col
 
 
 class QTableModel(AbstractModel):
     """ Tabular Q-learning prediction model.
 
         For every state (here: the agents current location ) the value for each of the actions is stored in a table.
-        The key for this table is (state + action). Initially all values are 0. When playing training games
-        after every move the value in the table is updated based on the reward gained after making the move. Training
-        ends after a fixed number of games, or earlier if a stopping criterion is reached (here: a 100% win rate).
+        The table is a dense array indexed by [row, col, action]. Initially all values are 0. When playing training
+        games after every move the value in the table is updated based on the reward gained after making the move.
+        Training ends after a fixed number of games, or earlier if a stopping criterion is reached (here: a 100% win
+        rate).
+
+        Training games are played by a compiled copy of the maze rules (see _run_episode), so the agent's moves are
+        not rendered during training. The Q-table is only rendered if requested via render_every.
     """
     default_check_convergence_every = 5  # by default check for convergence every # episodes
 
@@ -25,7 +130,9 @@ class QTableModel(AbstractModel):
         :param kwargs: model dependent init parameters
         """
         super().__init__(game, name="QTableModel", **kwargs)
-        self.Q = dict()  # table with value for (state, action) combination
+        nrows, ncols = game.maze.shape
+        # table with value for (row, col, action) combination
+        self.Q = np.zeros((nrows, ncols, len(game.actions)), dtype=np.float32)
 
     def train(self, stop_at_convergence=False, **kwargs):
         """ Train the model.
@@ -38,23 +145,35 @@ class QTableModel(AbstractModel):
             :keyword float exploration_decay: exploration rate reduction after each random step (<= 1, 1 = no at all)
             :keyword float learning_rate: (alpha) preference for using new knowledge (0 = not at all, 1 = only)
             :keyword int episodes: number of training games to play
+            :keyword int render_every: render the Q-table every # episodes (0 = never)
             :return int, datetime: number of training episodes, total time spent
         """
-        discount = kwargs.get("discount", 0.90)
+        # Q-table is float32, keep the update in single precision (rewards are cast likewise before training)
+        discount = np.float32(kwargs.get("discount", 0.90))
         exploration_rate = kwargs.get("exploration_rate", 0.10)
         # % reduction per step = 100 - exploration decay
         exploration_decay = kwargs.get("exploration_decay", 0.995)
-        learning_rate = kwargs.get("learning_rate", 0.10)
+        learning_rate = np.float32(kwargs.get("learning_rate", 0.10))
         episodes = max(kwargs.get("episodes", 1000), 1)
         check_convergence_every = kwargs.get(
             "check_convergence_every",
             self.default_check_convergence_every)
+        render_every = kwargs.get("render_every", 0)
 
         # variables for reporting purposes
         cumulative_reward = 0
         cumulative_reward_history = []
         win_history = []
 
+        walls = np.asarray(self.environment.maze == Cell.OCCUPIED, dtype=np.int8)
+        exit_col, exit_row = self.environment.exit_cell
+        minimum_reward = np.float32(self.environment.minimum_reward)
+        rewards = [np.float32(r) for r in (Maze.reward_exit, Maze.penalty_move, Maze.penalty_visited,
+                                           Maze.penalty_impossible_move)]
+
+        # the compiled episodes draw from numba's own generator, derive its seed from random so runs can be repeated
+        _seed(random.randrange(2 ** 32))
+
         start_list = list()
         start_time = datetime.now()
 
@@ -63,48 +182,22 @@ class QTableModel(AbstractModel):
             # optimization: make sure to start from all possible cells
             if not start_list:
                 start_list = self.environment.empty.copy()
-            start_cell = random.choice(start_list)
-            start_list.remove(start_cell)
-
-            state = self.environment.reset(start_cell)
-            # change np.ndarray to tuple so it can be used as dictionary key
-            state = tuple(state.flatten())
-
-            while True:
-                # choose action epsilon greedy (off-policy, instead of only
-                # using the learned policy)
-                if np.random.random() < exploration_rate:
-                    action = random.choice(self.environment.actions)
-                else:
-                    action = self.predict(state)
-                # step and get next state
-                next_state, reward, status = self.environment.step(action)
-                next_state = tuple(next_state.flatten())
-
-                cumulative_reward += reward
+                random.shuffle(start_list)
+            start_cell = start_list.pop()
 
-                if (state, action) not in self.Q.keys(
-                ):  # ensure value exists for (state, action) to avoid a KeyError
-                    self.Q[(state, action)] = 0.0
-
-                # Q formula with TD
-                max_next_Q = max([self.Q.get((next_state, a), 0.0)
-                                 for a in self.environment.actions])
-                self.Q[(state, action)] += learning_rate * (reward +
-                                                            discount * max_next_Q - self.Q[(state, action)])
-
-                if status in (
-                        Status.WIN, Status.LOSE):  # terminal state reached, stop training episode
-                    break
+            col, row = start_cell
 
-                state = next_state
+            episode_reward, won = _run_episode(self.Q, walls, row, col, exit_row, exit_col,
+                                               exploration_rate, learning_rate, discount, minimum_reward, *rewards)
+            cumulative_reward += episode_reward
+            status = Status.WIN if won else Status.LOSE
 
+            if render_every and episode % render_every == 0:
                 self.environment.render_q(self)
 
             cumulative_reward_history.append(cumulative_reward)
 
-            logging.info("episode: {:d}/{:d} | status: {:4s} | e: {:.5f}"
-                         .format(episode, episodes, status.name, exploration_rate))
+            logging.info("episode: %d/%d | status: %-4s | e: %.5f", episode, episodes, status.name, exploration_rate)
 
             if episode % check_convergence_every == 0:
                 # check if the current model does win from all starting cells
@@ -117,34 +210,28 @@ class QTableModel(AbstractModel):
 
             exploration_rate *= exploration_decay  # explore less as training progresses
 
-        logging.info(
-            "episodes: {:d} | time spent: {}".format(
-                episode,
-                datetime.now() -
-                start_time))
+        logging.info("episodes: %d | time spent: %s", episode, datetime.now() - start_time)
 
         return cumulative_reward_history, win_history, episode, datetime.now() - \
             start_time
 
-    def q(self, state) -> np.ndarray:
-        """ Get q values for all actions for a certain state. """
+    @staticmethod
+    def _index(state):
+        """ Convert a state (np.ndarray [[col, row]] or (col, row) tuple) to a (row, col) index into the Q-table. """
         if isinstance(state, np.ndarray):
-            state = tuple(state.flatten())
+            state = state.ravel()
+        col, row = state
+        return row, col
 
-        return np.array([self.Q.get((state, action), 0.0)
-                        for action in self.environment.actions])
+    def q(self, state) -> np.ndarray:
+        """ Get q values for all actions for a certain state. """
+        return self.Q[self._index(state)].copy()
 
     def predict(self, state):
         """ Policy: choose the action with the highest value from the Q-table.
             Random choice if multiple actions have the same (max) value.
 
-            :param np.ndarray state: game state
+            :param np.ndarray | tuple state: game state
             :return int: selected action
         """
-        q = self.q(state)
-
-        logging.debug("q[] = {}".format(q))
-
-        # get index of the action(s) with the max value
-        actions = np.nonzero(q == np.max(q))[0]
-        return random.choice(actions)
+        return greedy_action(self.Q[self._index(state)].tolist())
@@ -2,25 +2,46 @@ import logging
 import random
 from datetime import datetime
 
+import numba
 import numpy as np
 
 from environment import Status
-from models import AbstractModel
+from models import AbstractModel, greedy_action
+
+
+@numba.njit(cache=True)
+def _update_trace(Q, etrace, step_size, decay, threshold):
+    """ Update all Q's in the eligibility trace and decay the trace, in a single pass over both tables.
+
+        Q[s, a] += step_size * etrace[s, a], after which etrace[s, a] is multiplied by decay. Traces which drop
+        below threshold are set to 0, without this they keep on decaying into the (slow) subnormal float range.
+    """
+    nstates, nactions = etrace.shape
+    for s in range(nstates):
+        for a in range(nactions):
+            e = etrace[s, a]
+            if e != 0.0:
+                Q[s, a] += step_size * e
+                e *= decay
+                etrace[s, a] = e if e >= threshold else 0.0
 
 
 class QTableTraceModel(AbstractModel):
     """ Tabular Q-learning prediction model with eligibility trace.
 
         For every state (here: the agents current location ) the value for each of the actions is stored in a table.
-        The key for this table is (state + action). Initially all values are 0. When playing training games
+        The table is a dense array indexed by [state, action], where the state is the index of the cell as returned
+        by Maze.cell_index(). Initially all values are 0. When playing training games
         after every move the value in the table is updated based on the reward gained after making the move. Training
         ends after a fixed number of games, or earlier if a stopping criterion is reached (here: a 100% win rate).
 
         To speed up learning the model keeps track of the (state, action) pairs which have been visited before and
         also updates their values based on the current reward (a.k.a. eligibility trace). With every step the amount
-        in which previous values are updated decays.
+        in which previous values are updated decays. As in Watkins' Q(lambda) the trace is cleared whenever a
+        non-greedy action is taken, as the values which follow no longer belong to the learned policy.
     """
     default_check_convergence_every = 5  # by default check for convergence every # episodes
+    eligibility_threshold = 1e-6  # traces below this value are negligible and set to 0
 
     def __init__(self, game, **kwargs) -> None:
         """ Create a new prediction model for 'game'.
@@ -29,7 +50,9 @@ class QTableTraceModel(AbstractModel):
         :param kwargs: model dependent init parameters
         """
         super().__init__(game, name="QTableTraceModel", **kwargs)
-        self.Q = dict()  # table with value per (state, action) combination
+        nrows, ncols = game.maze.shape
+        # table with value per (state, action) combination, float32 is precise enough and halves the memory traffic
+        self.Q = np.zeros((nrows * ncols, len(game.actions)), dtype=np.float32)
 
     def train(self, stop_at_convergence=False, **kwargs):
         """ Train the model.
@@ -43,21 +66,27 @@ class QTableTraceModel(AbstractModel):
             :keyword float learning_rate: (alpha) preference for using new knowledge (0 = not at all, 1 = only)
             :keyword float eligibility_decay: (lambda) eligibility trace decay rate per step (0 = no trace, 1 = no decay)
             :keyword int episodes: number of training games to play
+            :keyword int render_every: render the Q-table every # episodes (0 = never)
             :return int, datetime: number of training episodes, total time spent
         """
-        discount = kwargs.get("discount", 0.90)
+        # Q-table is float32, keep the update in single precision
+        discount = np.float32(kwargs.get("discount", 0.90))
         exploration_rate = kwargs.get("exploration_rate", 0.10)
         exploration_decay = kwargs.get("exploration_decay", 0.995)  # % reduction per step = 100 - exploration decay
-        learning_rate = kwargs.get("learning_rate", 0.10)
-        eligibility_decay = kwargs.get("eligibility_decay", 0.80)  # = 20% reduction
+        learning_rate = np.float32(kwargs.get("learning_rate", 0.10))
+        eligibility_decay = np.float32(kwargs.get("eligibility_decay", 0.80))  # = 20% reduction
         episodes = max(kwargs.get("episodes", 1000), 1)
         check_convergence_every = kwargs.get("check_convergence_every", self.default_check_convergence_every)
+        render_every = kwargs.get("render_every", 0)
 
         # variables for reporting purposes
         cumulative_reward = 0
         cumulative_reward_history = []
         win_history = []
 
+        actions = self.environment.actions  # bind once, avoids attribute lookups in the step loop
+        n_actions = len(actions)
+
         start_list = list()
         start_time = datetime.now()
 
@@ -66,56 +95,52 @@ class QTableTraceModel(AbstractModel):
             # optimization: make sure to start from all possible cells
             if not start_list:
                 start_list = self.environment.empty.copy()
-            start_cell = random.choice(start_list)
-            start_list.remove(start_cell)
+                random.shuffle(start_list)
+            start_cell = start_list.pop()
 
-            state = self.environment.reset(start_cell)
-            state = tuple(state.flatten())  # change np.ndarray to tuple, so it can be used as dictionary key
+            self.environment.reset(start_cell)
+            state = self.environment.cell_index()  # an int is much cheaper to hash than the observed np.ndarray
 
-            etrace = dict()
+            etrace = np.zeros_like(self.Q)
 
             while True:
-                if np.random.random() < exploration_rate:
-                    action = random.choice(self.environment.actions)
+                if random.random() < exploration_rate:
+                    action = actions[random.randrange(n_actions)]
+                    if self.Q[state, action] < self.Q[state].max():
+                        etrace[:] = 0.0  # non-greedy, so earlier (state, action) pairs no longer lead to this update
                 else:
                     action = self.predict(state)
 
-                try:
-                    etrace[(state, action)] += 1
-                except KeyError:
-                    etrace[(state, action)] = 1
+                etrace[state, action] += 1
 
-                next_state, reward, status = self.environment.step(action)
-                next_state = tuple(next_state.flatten())
+                _, reward, status = self.environment.step(action)
+                next_state = self.environment.cell_index()
 
                 cumulative_reward += reward
 
-                if (state, action) not in self.Q.keys():  # ensure value exists for (state, action) to avoid a KeyError
-                    self.Q[(state, action)] = 0.0
-
-                max_next_Q = max([self.Q.get((next_state, a), 0.0) for a in self.environment.actions])
-
-                # update Q's in trace
-                delta = reward + discount * max_next_Q - self.Q[(state, action)]
+                # there is no future reward after a terminal state
+                if status in (Status.WIN, Status.LOSE):
+                    target = reward
+                else:
+                    target = reward + discount * self.Q[next_state].max()
 
-                for key in etrace.keys():
-                    self.Q[key] += learning_rate * delta * etrace[key]
+                # update Q's in trace and decay eligibility trace
+                delta = target - self.Q[state, action]
 
-                # decay eligibility trace
-                for key in etrace.keys():
-                    etrace[key] *= (discount * eligibility_decay)
+                _update_trace(self.Q, etrace, learning_rate * delta, discount * eligibility_decay,
+                              self.eligibility_threshold)
 
                 if status in (Status.WIN, Status.LOSE):  # terminal state reached, stop episode
                     break
 
                 state = next_state
 
+            if render_every and episode % render_every == 0:
                 self.environment.render_q(self)
 
             cumulative_reward_history.append(cumulative_reward)
 
-            logging.info("episode: {:d}/{:d} | status: {:4s} | e: {:.5f}"
-                         .format(episode, episodes, status.name, exploration_rate))
+            logging.info("episode: %d/%d | status: %-4s | e: %.5f", episode, episodes, status.name, exploration_rate)
 
             if episode % check_convergence_every == 0:
                 # check if the current model does win from all starting cells
@@ -128,27 +153,27 @@ class QTableTraceModel(AbstractModel):
 
             exploration_rate *= exploration_decay  # explore less as training progresses
 
-        logging.info("episodes: {:d} | time spent: {}".format(episode, datetime.now() - start_time))
+        logging.info("episodes: %d | time spent: %s", episode, datetime.now() - start_time)
 
         return cumulative_reward_history, win_history, episode, datetime.now() - start_time
 
-    def q(self, state) -> np.ndarray:
-        """ Get q values for all actions for a certain state. """
+    def _index(self, state):
+        """ Convert a state (np.ndarray [[col, row]], (col, row) tuple or cell index) to an index into the Q-table. """
         if type(state) == np.ndarray:
             state = tuple(state.flatten())
+        if type(state) == tuple:
+            state = self.environment.cell_index(state)
+        return state
 
-        return np.array([self.Q.get((state, action), 0.0) for action in self.environment.actions])
+    def q(self, state) -> np.ndarray:
+        """ Get q values for all actions for a certain state. """
+        return self.Q[self._index(state)].copy()
 
     def predict(self, state):
         """ Policy: choose the action with the highest value from the Q-table.
             Random choice if multiple actions have the same (max) value.
 
-            :param np.ndarray state: game state
+            :param np.ndarray | tuple | int state: game state, (col, row) or cell index
             :return int: selected action
         """
-        q = self.q(state)
-
-        logging.debug("q[] = {}".format(q))
-
-        actions = np.nonzero(q == np.max(q))[0]  # get index of the action(s) with the max value
-        return random.choice(actions)
+        return greedy_action(self.Q[self._index(state)].tolist())